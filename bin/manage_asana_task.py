@@ -4,56 +4,134 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import json
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from os import environ
-from textwrap import dedent
-from typing import Dict, Iterable, Tuple
+from typing import TYPE_CHECKING, Dict, FrozenSet, Tuple
 
-import bleach
 import requests
-from markdown import markdown
+
+if TYPE_CHECKING:
+    from bleach import Cleaner
+    from markdown import Markdown
 
 ASANA_API_ROOT = "https://app.asana.com/api/1.0/"
 ASANA_PROJECT = environ.get("ASANA_PROJECT")
 ASANA_TASK_COLLECTION_ENDPOINT = f"{ASANA_API_ROOT}tasks"
 ASANA_PROJECT_RESOURCE_ENDPOINT = f"{ASANA_API_ROOT}projects/{ASANA_PROJECT}"
 
+GITHUB_HTML_ROOT = "https://github.com/"
+GITHUB_API_REPOS_ROOT = "https://api.github.com/repos/"
+
 MESSAGE_UNABLE_TO_CREATE_ASANA_PERMALINK = "Error creating Asana task"
 
+# requests has no default timeout, so a stalled connection would otherwise
+# hang the Action until Github kills the job
+REQUEST_TIMEOUT_SECONDS = 30
+
 FLAG_ONLY_REACT_TO_SPECIFIED_USERS = "specified-users"
 FLAG_ONLY_REACT_TO_ALL = "all"
 
+# The parts of the request headers that don't depend on a token
+_ASANA_STATIC_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+}
+_GITHUB_STATIC_HEADERS = {
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+}
+
+# A single Session for the whole run, so that calls to the same host reuse a
+# pooled keep-alive connection rather than each paying for a new TLS handshake.
+# Auth headers stay per-request, because Asana and Github need different tokens.
+_SESSION = requests.Session()
+
 
 # Asana allows a fairly restrictive set of HTML tags it its Task body.
 # https://developers.asana.com/docs/rich-text#reading-rich-text
-ASANA_ALLOWED_TAGS_FOR_TASKS = {
-    "a",
-    "body",
-    "code",
-    "em",
-    "h1",
-    "h2",
-    "hr",
-    "li",
-    "ol",
-    "s",
-    "strong",
-    "u",
-    "ul",
-}
+ASANA_ALLOWED_TAGS_FOR_TASKS = frozenset(
+    {
+        "a",
+        "body",
+        "code",
+        "em",
+        "h1",
+        "h2",
+        "hr",
+        "li",
+        "ol",
+        "s",
+        "strong",
+        "u",
+        "ul",
+    }
+)
+
+# We sanitise with <p> allowed as well, and drop those <p>s afterwards - see
+# _sanitise_issue_body
+ASANA_ALLOWED_TAGS_FOR_TASKS__PLUS_P = ASANA_ALLOWED_TAGS_FOR_TASKS | frozenset({"p"})
+
+# Issue bodies that are just plain prose come out of Markdown + bleach as the
+# same text, with paragraphs separated by a blank line, so for those we can skip
+# both. This is deliberately conservative - if any of these match, the body
+# takes the full path:
+_NOT_PLAIN_TEXT = re.compile(
+    r"[^\n\w .,;:!?'\"()/%@$-]"  # anything but word characters and everyday punctuation
+    r"|_"  # \w includes _, which Markdown uses for emphasis
+    r"|^[-+=]"  # list items, setext headings and horizontal rules
+    r"|^\d+\."  # ordered list items
+    r"|^ | $",  # indented code, list continuations and hard line breaks
+    re.MULTILINE,
+)
+_PARAGRAPH_BREAK = re.compile(r"\n\n+")
+
+
+def log(*params: str) -> None:
+    sys.stdout.write(" ".join(params) + "\n")
+
+
+@lru_cache(maxsize=None)
+def _get_markdown_renderer() -> "Markdown":
+    """Return a Markdown instance to render issue bodies with.
+
+    Building one sets up all its processors and compiles their regexes, so we
+    only do that once and reset() it between documents instead. markdown is
+    imported here, rather than at the top of the module, so that runs which
+    never render an issue body don't pay to load it.
+    """
+    from markdown import Markdown
 
+    # HTML (rather than the default XHTML) output matches how bleach serialises
+    # void elements like the <hr> that Markdown renders for ---
+    return Markdown(output_format="html")
 
-def log(*params: Iterable) -> None:
-    sys.stdout.write(" ".join(params))
-    sys.stdout.write("\n")
+
+@lru_cache(maxsize=None)
+def _get_cleaner(tags: FrozenSet[str] = ASANA_ALLOWED_TAGS_FOR_TASKS__PLUS_P) -> "Cleaner":
+    """Return a bleach Cleaner that strips all but the given tags - by default,
+    Asana's tags plus <p>.
+
+    Each Cleaner is built once, rather than per call as bleach.clean() does,
+    and bleach (which pulls in all of html5lib) is imported here for the same
+    reason as markdown in _get_markdown_renderer.
+
+    NB: a Cleaner isn't thread-safe, so only use it from the main thread.
+    """
+    from bleach import Cleaner
+
+    return Cleaner(
+        tags=tags,
+        strip=True,
+    )
 
 
 def _get_default_asana_headers() -> Dict:
     token = environ.get("ASANA_PAT")
     headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
+        **_ASANA_STATIC_HEADERS,
         "Authorization": f"Bearer {token}",
     }
     return headers
@@ -62,9 +140,8 @@ def _get_default_asana_headers() -> Dict:
 def _get_default_github_headers() -> Dict:
     token = environ.get("REPO_TOKEN")
     headers = {
-        "Accept": "application/vnd.github+json",
+        **_GITHUB_STATIC_HEADERS,
         "Authorization": f"Bearer {token}",
-        "X-GitHub-Api-Version": "2022-11-28",
     }
     return headers
 
@@ -85,35 +162,37 @@ def _get_github_issue_field_gid(field_name: str = "Github Issue") -> str:
     issue_field_gid = environ.get("ASANA_GITHUB_ISSUE_CUSTOM_FIELD_GID", "")
 
     if not issue_field_gid:
-        project_resp = requests.get(
+        project_resp = _SESSION.get(
             ASANA_PROJECT_RESOURCE_ENDPOINT,
             headers=_get_default_asana_headers(),
+            timeout=REQUEST_TIMEOUT_SECONDS,
         )
         if project_resp.status_code == 200:
-            project_data = json.loads(project_resp.text)
-            for custom_field_spec in project_data.get("data", {}).get("custom_field_settings", []):
-                if custom_field_spec.get("custom_field", {}).get("name").lower() == field_name.lower():
-                    issue_field_gid = custom_field_spec.get("custom_field", {}).get("gid")
-                    log(f"Custom field {field_name} has gid of {issue_field_gid}")
-                    break
+            project_data = project_resp.json()
+            target_field_name = field_name.lower()
+            custom_fields = (
+                custom_field_spec.get("custom_field") or {} for custom_field_spec in project_data.get("data", {}).get("custom_field_settings", [])
+            )
+            issue_field_gid = next(
+                (custom_field.get("gid") for custom_field in custom_fields if (custom_field.get("name") or "").lower() == target_field_name),
+                "",
+            )
+            if issue_field_gid:
+                log(f"Custom field {field_name} has gid of {issue_field_gid}")
 
     return issue_field_gid
 
 
-def _build_task_body(
-    issue_body: str,
-    issue_url: str,
-    custom_gh_field_known: bool,
-) -> Tuple[str, bool]:
-    """Build a HTML string we can use for the task body in Asana.
+def _sanitise_issue_body(issue_body: str) -> Tuple[str, bool]:
+    """Render the GH Issue's Markdown to HTML and sanitise it so that it only
+    uses the HTML tags that Asana allows in a task body.
 
-    Note that only certain HTML tags are allowed, else the task creation
-    will fail. See https://developers.asana.com/docs/rich-text#reading-rich-text
+    See https://developers.asana.com/docs/rich-text#reading-rich-text
 
     Also note that line breaks (\n) are preserved and each line is rendered as a <p>
 
     Returns:
-        str: the formatted HTML for Asana
+        str: the sanitised HTML for Asana
         bool: whether the issue_body passed in has changed during re-formatting
     """
 
@@ -127,50 +206,75 @@ def _build_task_body(
     # a mess in Asana. We do add a note if the body has changed - but ignoring
     # insignificant changes to the issue_body takes a little legwork:
 
+    # Nothing to render: this is also what the full pipeline would give us
+    if not issue_body or issue_body.isspace():
+        return "", False
+
+    # Markdown treats \r\n and \r as line breaks, too
+    normalised_issue_body = issue_body.replace("\r\n", "\n").replace("\r", "\n")
+    if not _NOT_PLAIN_TEXT.search(normalised_issue_body):
+        return "\n\n".join(_PARAGRAPH_BREAK.split(normalised_issue_body.strip("\n"))), False
+
     content_changed_during_sanitization = False
-    content_disclaimer_string = ""
-    optional_link_string = ""
 
-    rendered_issue_body = markdown(issue_body)
+    rendered_issue_body = _get_markdown_renderer().reset().convert(issue_body)
 
-    # Do a first pass of sanitisation that includes a <p>, which we'll later drop
+    # Sanitise with <p> still allowed, so that we can drop the <p>s later.
     # We do this because it's simpler than comparing the various cases where a
     # new line is added/not added during cleaning (eg before/not before a list)
-    ASANA_ALLOWED_TAGS_FOR_TASKS__PLUS_P = ASANA_ALLOWED_TAGS_FOR_TASKS.union("p")
-
-    sanitised_issue_body = bleach.clean(
-        rendered_issue_body,
-        tags=ASANA_ALLOWED_TAGS_FOR_TASKS__PLUS_P,
-        strip=True,
-    )
+    sanitised_issue_body = _get_cleaner().clean(rendered_issue_body)
 
     # Is the sanitised body (so far) the same as the HTML rendered from Markdown?
-    # (aside from a <hr /> tweaked for HTML5)
-    rendered_issue_body_adjusted_for_insignificant_changes = rendered_issue_body.replace("<hr />", "<hr>")
-
-    if sanitised_issue_body != rendered_issue_body_adjusted_for_insignificant_changes:
+    # (aside from a raw <hr /> in the issue, which Markdown passes through as is)
+    if sanitised_issue_body != rendered_issue_body.replace("<hr />", "<hr>"):
         content_changed_during_sanitization = True
-        content_disclaimer_string = "<hr>\nNote: The original Issue contained content which cannot be displayed in an Asana Task"
 
-    # OK, now drop the <p> tags:
-    sanitised_issue_body = bleach.clean(
-        sanitised_issue_body,
-        tags=ASANA_ALLOWED_TAGS_FOR_TASKS,
-        strip=True,
-    )
+    # OK, now drop the <p> tags. Raw HTML in the issue can leave the sanitised
+    # body malformed (eg with a heading that's only closed after the next one
+    # opens), and a second bleach pass re-parses and re-nests that. A second pass
+    # also turns a form feed that ends a paragraph into "?" - which matters,
+    # because \x0c isn't allowed in the XML that Asana parses html_notes as.
+    # So those bodies still get one:
+    if "<" in issue_body or "\x0c" in issue_body:
+        return _get_cleaner(ASANA_ALLOWED_TAGS_FOR_TASKS).clean(sanitised_issue_body), content_changed_during_sanitization
+
+    # Otherwise the HTML came from Markdown alone and is well-formed, so the
+    # only other thing a second pass would do is drop the <p>s, and bleach has already
+    # stripped any attributes from them, so plain string replacement is enough.
+    # To match what bleach does when stripping a block-level tag, each <p>
+    # becomes a line break - unless no other tag has come before it, in which
+    # case bleach simply drops it.
+    first_tag_position = sanitised_issue_body.find("<")
+    if first_tag_position != -1 and sanitised_issue_body.startswith("<p>", first_tag_position):
+        sanitised_issue_body = sanitised_issue_body[:first_tag_position] + sanitised_issue_body[first_tag_position + len("<p>") :]
+    sanitised_issue_body = sanitised_issue_body.replace("<p>", "\n").replace("</p>", "")
+
+    return sanitised_issue_body, content_changed_during_sanitization
+
+
+def _build_task_body(
+    sanitised_issue_body: str,
+    issue_url: str,
+    custom_gh_field_known: bool,
+    content_changed_during_sanitization: bool,
+) -> str:
+    """Build a HTML string we can use for the task body in Asana, from an
+    issue body that has already been through _sanitise_issue_body
+
+    Returns:
+        str: the formatted HTML for Asana
+    """
+
+    html_body_parts = ["<body>", sanitised_issue_body]
 
     if not custom_gh_field_known:
-        optional_link_string = f'<a href="{issue_url}">Github</a>'
-
-    html_body = dedent(
-        f"""\
-        <body>
-        {sanitised_issue_body}
-        {optional_link_string}
-        {content_disclaimer_string}
-        </body>"""
-    )
-    return html_body, content_changed_during_sanitization
+        html_body_parts.append(f'<a href="{issue_url}">Github</a>')
+
+    if content_changed_during_sanitization:
+        html_body_parts.append("<hr>\nNote: The original Issue contained content which cannot be displayed in an Asana Task")
+
+    html_body_parts.append("</body>")
+    return "\n".join(html_body_parts)
 
 
 def create_task(
@@ -188,16 +292,29 @@ def create_task(
 
     task_permalink = MESSAGE_UNABLE_TO_CREATE_ASANA_PERMALINK
 
-    custom_gh_issue_field_gid = _get_github_issue_field_gid()
+    # Looking up the custom field costs a round trip to Asana, whereas rendering
+    # and sanitising the issue body is purely local work, so we overlap the two.
+    # (The task POST needs both, and the GH comment needs the task's permalink,
+    # so there's nothing else here that can usefully run concurrently.)
+    # If the field's GID is set in the env, there's no round trip to overlap.
+    if environ.get("ASANA_GITHUB_ISSUE_CUSTOM_FIELD_GID"):
+        custom_gh_issue_field_gid = _get_github_issue_field_gid()
+        sanitised_issue_body, github_description_was_changed_for_asana = _sanitise_issue_body(issue_body)
+    else:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            gid_future = executor.submit(_get_github_issue_field_gid)
+            sanitised_issue_body, github_description_was_changed_for_asana = _sanitise_issue_body(issue_body)
+            custom_gh_issue_field_gid = gid_future.result()
 
     custom_fields = {}
     if custom_gh_issue_field_gid:
         custom_fields[custom_gh_issue_field_gid] = issue_url
 
-    task_body, github_description_was_changed_for_asana = _build_task_body(
-        issue_body=issue_body,
+    task_body = _build_task_body(
+        sanitised_issue_body=sanitised_issue_body,
         issue_url=issue_url,
         custom_gh_field_known=bool(custom_gh_issue_field_gid),
+        content_changed_during_sanitization=github_description_was_changed_for_asana,
     )
 
     payload = {
@@ -209,18 +326,23 @@ def create_task(
         }
     }
 
-    resp = requests.post(
+    resp = _SESSION.post(
         ASANA_TASK_COLLECTION_ENDPOINT,
         json=payload,
         headers=_get_default_asana_headers(),
+        timeout=REQUEST_TIMEOUT_SECONDS,
     )
+    # If something's not right, we log the response and let the caller
+    # deal with things when they see task_permalink is a warning message
     if resp.status_code == 201:
-        task_permalink = json.loads(resp.text).get("data", {}).get("permalink_url")
-        log(f"Asana task created: {task_permalink}")
+        try:
+            task_permalink = resp.json()["data"]["permalink_url"]
+        except (KeyError, TypeError, ValueError):
+            log(f"Unexpected response from Asana: {resp.text}")
+        else:
+            log(f"Asana task created: {task_permalink}")
     else:
-        # Something's not right. Log the response and let the caller
-        # deal with things when they see task_permalink is a warning message
-        log(resp.content)
+        log(resp.text)
 
     return task_permalink, github_description_was_changed_for_asana
 
@@ -232,11 +354,10 @@ def _transform_to_api_url(html_url: str) -> str:
     # env vars required to configure the action with a bit of legwork. Risk
     # is if the API URL format changes, of course.
 
-    return html_url.replace(
-        "https://github.com/",
-        "https://api.github.com/repos/",
-        1,  # count of 1
-    )
+    if not html_url.startswith(GITHUB_HTML_ROOT):
+        return html_url
+
+    return GITHUB_API_REPOS_ROOT + html_url[len(GITHUB_HTML_ROOT) :]
 
 
 def add_task_as_comment_on_github_issue(
@@ -261,10 +382,11 @@ def add_task_as_comment_on_github_issue(
         comment += " **However**, some of the content was not mirrored due to markup restrictions."
         comment += " Please review the Asana Task."
 
-    resp = requests.post(
+    resp = _SESSION.post(
         commenting_url,
         json={"body": comment},
         headers=headers,
+        timeout=REQUEST_TIMEOUT_SECONDS,
     )
 
     if resp.status_code != 201:
@@ -287,7 +409,7 @@ def _may_bridge_to_asana(actor: str, repo_info: str) -> bool:
     """
 
     only_react_to_flag = environ.get("ONLY_REACT_TO")
-    actor_allowlist = [x.strip() for x in environ.get("ACTOR_ALLOWLIST", "").split(",")]
+    actor_allowlist = frozenset(x.strip() for x in environ.get("ACTOR_ALLOWLIST", "").split(","))
 
     if only_react_to_flag == FLAG_ONLY_REACT_TO_ALL:
         # Nothing to check - just forward everyone's issues -- this is probably